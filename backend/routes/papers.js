@@ -258,6 +258,10 @@ router.post('/generate', authenticateToken, validatePaperGeneration, async (req,
         console.log(`[ERROR] 任务失败:`, taskStatus.error_message);
         throw new Error(`AI任务生成失败: ${taskStatus.error_message}`);
       }
+      if (taskStatus.status === 'cancelled') {
+        console.log(`[ERROR] 任务已取消:`, taskStatus.error_message);
+        throw new Error(`AI任务已取消: ${taskStatus.error_message}`);
+      }
       console.log(`[POLLING] 任务 ${taskId} 状态: ${taskStatus.status}, 进度: ${taskStatus.progress || '处理中'}`);
     }
 
@@ -1,19 +1,49 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
+from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Header, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 import os
 import PyPDF2
 from io import BytesIO
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Iterator, Tuple
 import logging
 from datetime import datetime
 import uuid
 import asyncio
+import copy
+import gzip
+import hashlib
+import math
+import random
+import re
+import json
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import unicodedata
+import zlib
+from array import array
+from contextvars import ContextVar
+from collections import Counter, deque
 from enum import Enum
 
+# Optional faster JSON encoding and brotli compression for API responses
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # LangChain imports
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
+from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_google_genai import ChatGoogleGenerativeAI
 
@@ -28,10 +58,97 @@ class TaskStatus(str, Enum):
     PROCESSING = "processing"
     COMPLETED = "completed"
     FAILED = "failed"
+    CANCELLED = "cancelled"
 
 # In-memory task storage (in production, use Redis or database)
 task_storage: Dict[str, Dict[str, Any]] = {}
 
+# Idempotency-Key header -> task_id, so retried submissions map back to the original task
+idempotency_keys: Dict[str, str] = {}
+
+# Normalized input key -> shared generation currently in flight.
+# Concurrent tasks with identical inputs await the same asyncio task instead of
+# issuing their own LLM call; the entry counts waiters so the shared call is
+# only cancelled once nobody needs it any more.
+inflight_generations: Dict[str, Dict[str, Any]] = {}
+
+# task_id -> asyncio task doing the work, so the task can be cancelled
+running_tasks: Dict[str, asyncio.Task] = {}
+
+# Limit on concurrent provider calls. Cancelled tasks release their slot immediately.
+MAX_CONCURRENT_GENERATIONS = int(os.getenv("MAX_CONCURRENT_GENERATIONS", "10"))
+generation_slots = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+
+# Requests above SHARD_SIZE questions are split into parallel shards of at most
+# SHARD_SIZE questions each; a single prompt cannot reliably return more than
+# MAX_QUESTIONS_PER_CALL within the token limit.
+SHARD_SIZE = int(os.getenv("SHARD_SIZE", "5"))
+SHARD_MAX_ATTEMPTS = int(os.getenv("SHARD_MAX_ATTEMPTS", "2"))
+MAX_QUESTIONS_PER_CALL = 10
+DIFFICULTY_LEVELS = ["easy", "medium", "hard"]
+
+# Near-duplicate detection: estimated Jaccard similarity at or above this drops a question,
+# and dropped slots are re-requested at most DEDUP_MAX_REGENERATIONS times
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.6"))
+DEDUP_MAX_REGENERATIONS = int(os.getenv("DEDUP_MAX_REGENERATIONS", "1"))
+
+# SQLite file for the persistent question bank (empty disables the bank)
+QUESTION_BANK_PATH = os.getenv("QUESTION_BANK_PATH", "data/question_bank.db")
+
+# Event-loop lag monitoring: the loop is sampled every EVENT_LOOP_SAMPLE_INTERVAL
+# seconds, and a watchdog thread captures the loop's stack when it has not
+# ticked for EVENT_LOOP_STALL_THRESHOLD_MS. In strict mode a request whose
+# handler blocked the loop that long raises instead of returning (for tests).
+EVENT_LOOP_MONITOR = os.getenv("EVENT_LOOP_MONITOR", "true").lower() == "true"
+EVENT_LOOP_SAMPLE_INTERVAL = float(os.getenv("EVENT_LOOP_SAMPLE_INTERVAL", "0.1"))
+EVENT_LOOP_STALL_THRESHOLD_MS = float(os.getenv("EVENT_LOOP_STALL_THRESHOLD_MS", "200"))
+EVENT_LOOP_STRICT = os.getenv("EVENT_LOOP_STRICT", "false").lower() == "true"
+
+# Idle-time pre-generation only runs while no interactive generation is active
+# and, when PROVIDER_RATE_LIMIT_RPM is set, while provider calls in the last
+# minute stay below PREGENERATION_MAX_RATE_SHARE of that limit
+PROVIDER_RATE_LIMIT_RPM = int(os.getenv("PROVIDER_RATE_LIMIT_RPM", "0"))
+PREGENERATION_MAX_RATE_SHARE = float(os.getenv("PREGENERATION_MAX_RATE_SHARE", "0.5"))
+PREGENERATION_POLL_INTERVAL = 0.05
+
+# Response bodies smaller than this are sent uncompressed
+COMPRESSION_MIN_SIZE = 1024
+TERMINAL_STATUSES = [TaskStatus.COMPLETED, TaskStatus.FAILED, TaskStatus.CANCELLED]
+
+# Auto-cancel active tasks nobody has polled for this many seconds (0 disables)
+TASK_POLL_TIMEOUT = int(os.getenv("TASK_POLL_TIMEOUT", "0"))
+
+# Counters for provider usage and how many calls coalescing avoided
+generation_stats: Dict[str, int] = {
+    "provider_calls": 0,
+    "calls_saved_by_coalescing": 0,
+    "near_duplicates_dropped": 0,
+    "bank_hits": 0,
+    "questions_requested": 0,
+    "pregeneration_yields": 0,
+    "prompt_tokens": 0,
+    "cached_prompt_tokens": 0,
+    "completion_tokens": 0
+}
+
+# Interactive provider calls in progress or waiting for a slot; pre-generation yields while non-zero
+provider_load: Dict[str, int] = {"interactive": 0}
+
+# Token prices in USD per million tokens, for cost estimates (0 = unknown)
+PROMPT_TOKEN_PRICE = float(os.getenv("PROMPT_TOKEN_PRICE", "0"))
+CACHED_PROMPT_TOKEN_PRICE = float(os.getenv("CACHED_PROMPT_TOKEN_PRICE", "0"))
+COMPLETION_TOKEN_PRICE = float(os.getenv("COMPLETION_TOKEN_PRICE", "0"))
+
+# Per-call usage records of the generation running in the current asyncio context
+current_call_usage: ContextVar[Optional[List[Dict[str, Any]]]] = ContextVar("current_call_usage", default=None)
+
+# Monotonic timestamps of recent provider calls, for rate-limit headroom
+provider_call_times: deque = deque()
+
+# Pre-generation jobs by job_id, and the queue of jobs with chunks left to generate
+pregeneration_jobs: Dict[str, Dict[str, Any]] = {}
+pregeneration_queue: deque = deque()
+
 # FastAPI app
 app = FastAPI(
     title="Question Generator API",
@@ -51,7 +168,9 @@ app.add_middleware(
 # Pydantic models
 class QuestionInput(BaseModel):
     materials: str = Field(..., description="Educational materials for question generation")
-    num_questions: int = Field(default=5, ge=1, le=10, description="Number of questions to generate")
+    num_questions: int = Field(default=5, ge=1, le=50, description="Number of questions to generate")
+    course_id: Optional[str] = Field(default=None, description="Course identifier; questions are deduplicated against earlier papers for the same course")
+    use_question_bank: bool = Field(default=True, description="Serve matching questions from the question bank before calling the LLM")
 
 class QuestionResponse(BaseModel):
     question: str
@@ -63,6 +182,8 @@ class QuestionResponse(BaseModel):
 class GenerationResult(BaseModel):
     questions: List[QuestionResponse]
     generation_time: float
+    bank_hits: Optional[int] = Field(default=None, description="Questions served from the question bank")
+    bank_hit_ratio: Optional[float] = Field(default=None, description="Share of requested questions served from the question bank")
 
 class TaskSubmitResponse(BaseModel):
     task_id: str
@@ -76,11 +197,50 @@ class TaskStatusResponse(BaseModel):
     updated_at: datetime
     progress: Optional[str] = None
     error_message: Optional[str] = None
+    shards_total: Optional[int] = None
+    shards_completed: Optional[int] = None
+
+class ProviderCallUsage(BaseModel):
+    prompt_version: str
+    prompt_tokens: int
+    cached_prompt_tokens: int
+    completion_tokens: int
+    latency: float
+
+class UsageSummary(BaseModel):
+    calls: List[ProviderCallUsage]
+    prompt_tokens: int
+    cached_prompt_tokens: int
+    completion_tokens: int
+    cache_hit_ratio: Optional[float] = Field(default=None, description="Share of prompt tokens served from the provider's prefix cache")
+    total_latency: float
+    estimated_cost: Optional[float] = Field(default=None, description="Estimated cost in USD, if token prices are configured")
+
+class PregenerationInput(BaseModel):
+    materials: str = Field(..., description="Course materials to prepare reserve questions for")
+    questions_per_chunk: int = Field(default=5, ge=1, le=10, description="Reserve questions to bank for each material chunk")
+
+class PregenerationStatusResponse(BaseModel):
+    job_id: str
+    status: TaskStatus
+    created_at: datetime
+    updated_at: datetime
+    completed_at: Optional[datetime] = None
+    chunks_total: int
+    chunks_already_banked: int
+    chunks_completed: int
+    chunks_failed: int
+    questions_banked: int
+    yields: int = Field(description="Times the job stepped aside for interactive generation")
+    error_message: Optional[str] = None
 
 class TaskResultResponse(BaseModel):
     task_id: str
     status: TaskStatus
     result: Optional[GenerationResult] = None
+    partial: bool = Field(default=False, description="True while a sharded task is still running and only completed shards are included")
+    tokens_saved: Optional[int] = Field(default=None, description="Estimated prompt tokens removed by materials normalization")
+    usage: Optional[UsageSummary] = None
     error_message: Optional[str] = None
     created_at: datetime
     completed_at: Optional[datetime] = None
@@ -136,15 +296,19 @@ def get_llm_google():
     return llm
 
 
+# Materials longer than this are cut down to their first chunk for a single prompt
+MAX_PROMPT_MATERIALS = 8000
+
 # Text splitter for large documents
 text_splitter = RecursiveCharacterTextSplitter(
     chunk_size=4000,
     chunk_overlap=200
 )
 
-# Prompt template (替换为这个新版本)
+# Prompt template v1: instructions interleaved with the per-call values.
+# Kept for comparison with the cache-friendly v2 layout below.
 prompt_template = PromptTemplate(
-    input_variables=["materials", "num_questions"],
+    input_variables=["materials", "num_questions", "requirements"],
     template="""You are an expert exam creator creating questions for a closed-book exam. Your task is to generate {num_questions} high-quality exam questions based on the provided "Educational Materials". Students will NOT have access to these materials during the exam. You must follow these critical rules:
 
 1. Create questions that test students' understanding of the key concepts, NOT their ability to find information
@@ -186,12 +350,497 @@ Example Format:
     }}
   ]
 }}
+{requirements}
+Generate the questions now:"""
+)
+
+# Prompt template v2: a static system prefix that is byte-identical on every
+# call, so provider prefix caches can reuse it, followed by a user message
+# with the materials first and the per-call count and requirements last, so
+# shard retries and regenerations on the same chunk share the longer prefix
+prompt_system_prefix_v2 = """You are an expert exam creator creating questions for a closed-book exam. Your task is to generate the number of high-quality exam questions requested by the user, based on the "Educational Materials" the user provides. Students will NOT have access to these materials during the exam. You must follow these critical rules:
+
+1. Create questions that test students' understanding of the key concepts, NOT their ability to find information
+2. Each question must include all necessary context and definitions needed to answer it
+3. Questions should be answerable based on what students should have learned from the materials
+4. Use concrete examples and specific scenarios to test understanding
+5. For definitions or concepts, incorporate the key elements into the question instead of asking students to recall the exact definition
+
+For each question, you MUST generate the following five fields in a JSON format:
+1. "question": The question text itself. Must quote or paraphrase specific content from the materials. Include line numbers or sections if possible.
+2. "answer": A concise answer that directly quotes or closely paraphrases the materials. Must include the specific location or context from where the answer was derived.
+3. "explanation": A detailed explanation that:
+   - Quotes the exact relevant portions of the materials
+   - Explains how the answer is derived from these quotes
+   - Shows the logical connection between the materials and the answer
+   - Must be more detailed than the answer
+4. "difficulty": The difficulty level (must be one of: "easy", "medium", "hard"):
+   - "easy": Direct quotes or fact recall from the materials
+   - "medium": Requires understanding relationships between concepts in the materials
+   - "hard": Requires synthesizing multiple parts of the materials
+5. "topic": A specific topic or concept from the materials, with the section or context where it appears
+
+Format your entire response as a single valid JSON object with a key "questions", which contains a list of question objects. Do not add any text before or after the JSON object.
+
+Example Format:
+{
+  "questions": [
+    {
+      "question": "A company implements web analytics to track user behavior on their e-commerce website. They collect data on page views, click patterns, and conversion rates. What is the primary business purpose of collecting and analyzing this data?",
+      "answer": "The primary purpose is to analyze campaign Return On Investment (ROI) by measuring how marketing investments translate into tangible business outcomes through systematic data collection and analysis.",
+      "explanation": "This question tests understanding of the core purpose of web analytics in a business context. A strong answer demonstrates knowledge that: 1) Web analytics involves systematic data collection (page views, clicks, etc.), 2) The ultimate goal is ROI analysis, and 3) This connects marketing investments to business outcomes. Students should understand not just what is collected, but why it matters for business decision-making.",
+      "difficulty": "medium",
+      "topic": "Web Analytics Business Application"
+    }
+  ]
+}"""
+
+prompt_suffix_template_v2 = PromptTemplate(
+    input_variables=["materials", "num_questions", "requirements"],
+    template="""Educational Materials:
+---
+{materials}
+---
 
+Generate {num_questions} questions.
+{requirements}
 Generate the questions now:"""
 )
 
+# Prompt versions, compiled once at startup. "system" is the cacheable prefix
+# message (None for single-message layouts).
+PROMPT_TEMPLATES: Dict[str, Dict[str, Any]] = {
+    "v1": {"system": None, "template": prompt_template},
+    "v2": {"system": SystemMessage(content=prompt_system_prefix_v2), "template": prompt_suffix_template_v2}
+}
+
+PROMPT_VERSION = os.getenv("PROMPT_VERSION", "v2")
+if PROMPT_VERSION not in PROMPT_TEMPLATES:
+    logger.warning(f"Unknown PROMPT_VERSION {PROMPT_VERSION!r}, using v2")
+    PROMPT_VERSION = "v2"
+
+# Near-duplicate question detection (MinHash signatures + LSH banding)
+MINHASH_PERMUTATIONS = 32
+LSH_BANDS = 8
+SHINGLE_SIZE = 2
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_rng = random.Random(20240901)
+_MINHASH_PARAMS = [
+    (_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(0, _MINHASH_PRIME))
+    for _ in range(MINHASH_PERMUTATIONS)
+]
+
+# CJK characters are tokens on their own; other scripts tokenize into words
+_CJK_RANGES = r"\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_CJK_PATTERN = re.compile(f"[{_CJK_RANGES}]")
+_TOKEN_PATTERN = re.compile(f"[{_CJK_RANGES}]|[^\\W_]+")
+
+def question_signature(text: str) -> Optional[array]:
+    """MinHash signature over token shingles of a question, or None if it has no tokens"""
+    tokens = _TOKEN_PATTERN.findall(unicodedata.normalize("NFKC", text).casefold())
+    if not tokens:
+        return None
+    
+    grams = [" ".join(tokens[i:i + SHINGLE_SIZE]) for i in range(max(1, len(tokens) - SHINGLE_SIZE + 1))]
+    shingles = {zlib.crc32(gram.encode("utf-8")) for gram in grams}
+    
+    # Keep the low 32 bits of each minimum to halve the memory held by the course history
+    return array("I", (
+        min((a * shingle + b) % _MINHASH_PRIME for shingle in shingles) & 0xFFFFFFFF
+        for a, b in _MINHASH_PARAMS
+    ))
+
+class NearDuplicateIndex:
+    """LSH index over MinHash signatures.
+    
+    Signatures are split into LSH_BANDS bands; only questions sharing at least
+    one band bucket are compared, so lookups stay near-constant time as the
+    index grows.
+    """
+    
+    def __init__(self):
+        self.signatures: List[array] = []
+        # Band key -> signature index, or a list of indexes once a bucket has several
+        self.buckets: Dict[int, Any] = {}
+        self.rejected = 0
+    
+    def __len__(self) -> int:
+        return len(self.signatures)
+    
+    def _band_keys(self, signature: array) -> Iterator[int]:
+        rows = MINHASH_PERMUTATIONS // LSH_BANDS
+        for band in range(LSH_BANDS):
+            yield hash((band, signature[band * rows:(band + 1) * rows].tobytes()))
+    
+    def contains_near_duplicate(self, signature: array) -> bool:
+        checked = set()
+        for key in self._band_keys(signature):
+            bucket = self.buckets.get(key, ())
+            for idx in (bucket,) if isinstance(bucket, int) else bucket:
+                if idx in checked:
+                    continue
+                checked.add(idx)
+                other = self.signatures[idx]
+                matches = sum(1 for x, y in zip(signature, other) if x == y)
+                if matches / MINHASH_PERMUTATIONS >= NEAR_DUPLICATE_THRESHOLD:
+                    return True
+        return False
+    
+    def add(self, signature: array):
+        idx = len(self.signatures)
+        self.signatures.append(signature)
+        for key in self._band_keys(signature):
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                self.buckets[key] = idx
+            elif isinstance(bucket, int):
+                self.buckets[key] = [bucket, idx]
+            else:
+                bucket.append(idx)
+
+# course_id -> index of questions already issued for that course
+question_history: Dict[str, NearDuplicateIndex] = {}
+
+def accept_question(question: dict, paper_index: NearDuplicateIndex, history_index: Optional[NearDuplicateIndex]) -> bool:
+    """Add a question to the paper index unless it near-duplicates the paper or course history"""
+    signature = question_signature(str(question.get("question", "")))
+    if signature is None:
+        return True
+    
+    if paper_index.contains_near_duplicate(signature) or (
+        history_index is not None and history_index.contains_near_duplicate(signature)
+    ):
+        paper_index.rejected += 1
+        generation_stats["near_duplicates_dropped"] += 1
+        return False
+    
+    paper_index.add(signature)
+    return True
+
+def chunk_fingerprint(text: str) -> str:
+    """Stable fingerprint of a source chunk, ignoring case and whitespace"""
+    normalized = " ".join(text.split()).casefold()
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+def index_terms(*texts: str) -> set:
+    """Terms for the question bank's inverted index"""
+    terms = set()
+    for text in texts:
+        for token in _TOKEN_PATTERN.findall(unicodedata.normalize("NFKC", text).casefold()):
+            # Skip short Latin-script noise words; single CJK characters are meaningful
+            if len(token) >= 3 or not token.isascii():
+                terms.add(token)
+    return terms
+
+class QuestionBank:
+    """SQLite-backed store of generated questions.
+    
+    Questions are indexed by the fingerprints of the source chunks they were
+    generated from, and by an inverted index over topic and question terms.
+    """
+    
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS bank_questions (
+                id INTEGER PRIMARY KEY,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                difficulty TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                explanation TEXT NOT NULL,
+                course_id TEXT,
+                created_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS bank_sources (
+                chunk_hash TEXT NOT NULL,
+                question_id INTEGER NOT NULL,
+                PRIMARY KEY (chunk_hash, question_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS bank_terms (
+                term TEXT NOT NULL,
+                question_id INTEGER NOT NULL,
+                PRIMARY KEY (term, question_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS bank_course_questions (
+                course_id TEXT NOT NULL,
+                question_id INTEGER NOT NULL,
+                PRIMARY KEY (course_id, question_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_bank_questions_topic ON bank_questions(topic);
+            CREATE INDEX IF NOT EXISTS idx_bank_questions_course ON bank_questions(course_id);
+        """)
+        # Questions generated for a course count as issued to it (covers banks
+        # created before issued questions were tracked)
+        self.conn.execute(
+            "INSERT OR IGNORE INTO bank_course_questions (course_id, question_id) "
+            "SELECT course_id, id FROM bank_questions WHERE course_id IS NOT NULL"
+        )
+        self.conn.commit()
+        # Kept up to date by add() so len() never queries or waits for the lock
+        self.size = self.conn.execute("SELECT COUNT(*) FROM bank_questions").fetchone()[0]
+    
+    def __len__(self) -> int:
+        return self.size
+    
+    def add(self, entries: List[tuple], course_id: Optional[str] = None):
+        """Store (question, source chunk fingerprints) pairs"""
+        now = datetime.now().isoformat()
+        with self.lock:
+            with self.conn:
+                for question, fingerprints in entries:
+                    cursor = self.conn.execute(
+                        "INSERT INTO bank_questions (question, answer, difficulty, topic, explanation, course_id, created_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            str(question.get("question", "")),
+                            str(question.get("answer", "")),
+                            str(question.get("difficulty", "medium")),
+                            str(question.get("topic", "general")),
+                            str(question.get("explanation", "")),
+                            course_id,
+                            now
+                        )
+                    )
+                    question_id = cursor.lastrowid
+                    if course_id is not None:
+                        self.conn.execute(
+                            "INSERT OR IGNORE INTO bank_course_questions (course_id, question_id) VALUES (?, ?)",
+                            (course_id, question_id)
+                        )
+                    self.conn.executemany(
+                        "INSERT OR IGNORE INTO bank_sources (chunk_hash, question_id) VALUES (?, ?)",
+                        [(fingerprint, question_id) for fingerprint in fingerprints]
+                    )
+                    self.conn.executemany(
+                        "INSERT OR IGNORE INTO bank_terms (term, question_id) VALUES (?, ?)",
+                        [(term, question_id) for term in index_terms(question.get("topic", ""), question.get("question", ""))]
+                    )
+            self.size += len(entries)
+    
+    def _fetch(self, query: str, params: tuple, with_id: bool = False) -> List[dict]:
+        columns = ["question", "answer", "difficulty", "topic", "explanation"] + (["id"] if with_id else [])
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+    
+    def record_issued(self, course_id: str, question_ids: List[int]):
+        """Remember that banked questions were served to a course"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO bank_course_questions (course_id, question_id) VALUES (?, ?)",
+                [(course_id, question_id) for question_id in question_ids]
+            )
+    
+    def course_questions(self, course_id: str) -> List[str]:
+        """Text of every question issued to a course, generated or served from the bank"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT q.question FROM bank_course_questions c JOIN bank_questions q ON q.id = c.question_id "
+                "WHERE c.course_id = ? ORDER BY q.id", (course_id,)
+            ).fetchall()
+        return [row[0] for row in rows]
+    
+    def count_by_source(self, fingerprint: str) -> int:
+        """Number of banked questions generated from a source chunk"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM bank_sources WHERE chunk_hash = ?", (fingerprint,)
+            ).fetchone()[0]
+    
+    def find_by_sources(self, fingerprints: List[str], limit: int) -> List[Tuple[int, dict]]:
+        """(question id, question) pairs generated from any of the given source
+        chunks, most chunk overlap first"""
+        if not fingerprints:
+            return []
+        placeholders = ",".join("?" * len(fingerprints))
+        rows = self._fetch(
+            "SELECT q.question, q.answer, q.difficulty, q.topic, q.explanation, q.id "
+            "FROM bank_sources s JOIN bank_questions q ON q.id = s.question_id "
+            f"WHERE s.chunk_hash IN ({placeholders}) "
+            "GROUP BY q.id ORDER BY COUNT(*) DESC, q.id DESC LIMIT ?",
+            (*fingerprints, limit),
+            with_id=True
+        )
+        return [(row.pop("id"), row) for row in rows]
+    
+    def search(self, text: str, topic: Optional[str], difficulty: Optional[str], limit: int) -> List[dict]:
+        """Look up questions through the inverted index, ranked by matching terms"""
+        terms = list(index_terms(text, topic or ""))
+        if not terms:
+            return []
+        placeholders = ",".join("?" * len(terms))
+        query = (
+            "SELECT q.question, q.answer, q.difficulty, q.topic, q.explanation "
+            "FROM bank_terms t JOIN bank_questions q ON q.id = t.question_id "
+            f"WHERE t.term IN ({placeholders})"
+        )
+        params: List[Any] = list(terms)
+        if difficulty:
+            query += " AND q.difficulty = ?"
+            params.append(difficulty)
+        query += " GROUP BY q.id ORDER BY COUNT(*) DESC, q.id DESC LIMIT ?"
+        params.append(limit)
+        return self._fetch(query, tuple(params))
+
+question_bank: Optional[QuestionBank] = QuestionBank(QUESTION_BANK_PATH) if QUESTION_BANK_PATH else None
+
+def valid_bank_entries(entries: List[tuple]) -> List[tuple]:
+    """Keep only (question, fingerprints) entries whose question is well-formed"""
+    valid = []
+    for question, fingerprints in entries:
+        try:
+            QuestionResponse(**question)
+        except (ValidationError, TypeError):
+            logger.warning(f"Not banking malformed question: {str(question)[:200]}")
+            continue
+        valid.append((question, fingerprints))
+    return valid
+
+def build_course_history(course_id: str) -> NearDuplicateIndex:
+    """Rebuild a course's duplicate history from the questions banked for it"""
+    history = NearDuplicateIndex()
+    for text in question_bank.course_questions(course_id):
+        signature = question_signature(text)
+        if signature is not None:
+            history.add(signature)
+    return history
+
+async def get_course_history(course_id: Optional[str]) -> Optional[NearDuplicateIndex]:
+    """Course history index, loaded from the question bank on first use after a restart"""
+    if not course_id:
+        return None
+    if course_id not in question_history and question_bank is not None:
+        history = await asyncio.to_thread(build_course_history, course_id)
+        # A concurrent task for the same course may have loaded it first
+        question_history.setdefault(course_id, history)
+    return question_history.get(course_id)
+
+# Materials normalization: strip PDF boilerplate before chunking and prompting.
+# A short line found on at least BOILERPLATE_PAGE_RATIO of the pages of a
+# document with BOILERPLATE_MIN_PAGES or more pages is treated as a running
+# header, footer or slide template line.
+BOILERPLATE_MIN_PAGES = 3
+BOILERPLATE_PAGE_RATIO = 0.5
+BOILERPLATE_MAX_LINE_LENGTH = 120
+# Page numbers, symbol-only lines and repeats that differ only in their digits
+# are only stripped from up to this many non-blank lines (at most a quarter of
+# the page) at the top and bottom of each page of a multi-page document
+PAGE_EDGE_LINES = 3
+
+_INLINE_SPACE_PATTERN = re.compile(r"[ \t\u00a0\u3000]+")
+_LEADING_SPACE_PATTERN = re.compile(r"^[ \t\u00a0\u3000]*")
+_DIGITS_PATTERN = re.compile(r"\d+")
+_PAGE_NUMBER_PATTERN = re.compile(
+    r"^(?:page\s*)?[-–—]?\s*\d{1,4}\s*[-–—]?(?:\s*(?:/|of)\s*\d{1,4})?$|^第\s*\d+\s*页(?:\s*[,，/]?\s*共\s*\d+\s*页)?$",
+    re.IGNORECASE
+)
+_TOC_LINE_PATTERN = re.compile(r"(?:\.\s*){5,}\d+$")
+_CONTENT_PATTERN = re.compile(r"[^\W_]")
+_LETTER_PATTERN = re.compile(r"[^\W\d_]")
+_HYPHEN_BREAK_PATTERN = re.compile(r"([^\W\d_])-\n([a-z])")
+_BLANK_LINES_PATTERN = re.compile(r"\n{3,}")
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count: one per CJK character, one per four other characters"""
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk) // 4
+
+def normalize_materials(text: str) -> Tuple[str, Dict[str, int]]:
+    """Remove repeated headers/footers, page numbers and non-content lines, rejoin
+    hyphenated words and collapse whitespace.
+    
+    Pages are separated by form feeds, as produced by extract_pdf_text. Page
+    numbers and symbol-only lines are only removed near page edges of
+    multi-page documents; leading indentation is kept.
+    Returns the normalized text and statistics about what was removed.
+    """
+    pages = text.split("\f")
+    page_lines = []
+    page_edges = []
+    for page in pages:
+        lines = []
+        for line in page.splitlines():
+            indent = _LEADING_SPACE_PATTERN.match(line).group()
+            line = _INLINE_SPACE_PATTERN.sub(" ", line).strip()
+            key = line.casefold()
+            lines.append((indent + line if line else "", key, _DIGITS_PATTERN.sub("#", key)))
+        page_lines.append(lines)
+        
+        edges = set()
+        if len(pages) > 1:
+            content_lines = [i for i, (line, _, _) in enumerate(lines) if line]
+            # Short pages get a narrower edge so it never reaches the body
+            width = max(1, min(PAGE_EDGE_LINES, len(content_lines) // 4))
+            edges.update(content_lines[:width] + content_lines[-width:])
+        page_edges.append(edges)
+    
+    # Count on how many pages each short line occurs. Running headers and
+    # footers sit near page edges and may carry page or chapter numbers, so
+    # edge lines are compared with digits masked; elsewhere only exact repeats
+    # count, so e.g. "Example 4.1", "Example 4.2" in the body are kept.
+    repeated_edge = set()
+    repeated_exact = set()
+    if len(pages) >= BOILERPLATE_MIN_PAGES:
+        edge_counts = Counter()
+        exact_counts = Counter()
+        for lines, edges in zip(page_lines, page_edges):
+            short = [(i, key, masked) for i, (line, key, masked) in enumerate(lines)
+                     if line and len(key) <= BOILERPLATE_MAX_LINE_LENGTH]
+            edge_counts.update({masked for i, _, masked in short if i in edges})
+            exact_counts.update({key for _, key, _ in short})
+        threshold = max(BOILERPLATE_MIN_PAGES, len(pages) * BOILERPLATE_PAGE_RATIO)
+        repeated_edge = {key for key, count in edge_counts.items() if count >= threshold}
+        repeated_exact = {key for key, count in exact_counts.items() if count >= threshold}
+    
+    kept = []
+    lines_removed = 0
+    for lines, edges in zip(page_lines, page_edges):
+        for i, (line, key, masked) in enumerate(lines):
+            if not line:
+                kept.append("")
+            elif (
+                (i in edges and (
+                    masked in repeated_edge
+                    or _PAGE_NUMBER_PATTERN.match(line.lstrip())
+                    or not _CONTENT_PATTERN.search(line)
+                ))
+                # Exact repeats without letters (e.g. a "0" table cell) are content
+                or (key in repeated_exact and _LETTER_PATTERN.search(line))
+                or _TOC_LINE_PATTERN.search(line)
+            ):
+                lines_removed += 1
+            else:
+                kept.append(line)
+        kept.append("")
+    
+    normalized = "\n".join(kept)
+    normalized = _HYPHEN_BREAK_PATTERN.sub(r"\1\2", normalized)
+    normalized = _BLANK_LINES_PATTERN.sub("\n\n", normalized).strip("\n")
+    if not normalized:
+        # Nothing recognisable as content; leave the materials as they were
+        normalized = text.replace("\f", "\n").strip()
+        lines_removed = 0
+    
+    tokens_before = estimate_tokens(text)
+    tokens_after = estimate_tokens(normalized)
+    return normalized, {
+        "chars_before": len(text),
+        "chars_after": len(normalized),
+        "lines_removed": lines_removed,
+        "tokens_before": tokens_before,
+        "tokens_saved": max(0, tokens_before - tokens_after)
+    }
+
 def extract_pdf_text(pdf_file: UploadFile) -> str:
-    """Extract text from PDF file with better encoding handling"""
+    """Extract text from PDF file with better encoding handling.
+    
+    Pages are separated by form feeds so normalize_materials can detect
+    per-page boilerplate.
+    """
     try:
         content = pdf_file.file.read()
         
@@ -203,7 +852,7 @@ def extract_pdf_text(pdf_file: UploadFile) -> str:
                 for page in pdf.pages[:20]:  # Limit to 20 pages
                     page_text = page.extract_text(x_tolerance=3, y_tolerance=3)
                     if page_text:
-                        text += page_text + "\n"
+                        text += page_text + "\n\f"
                 
                 if text.strip():
                     return text
@@ -227,7 +876,7 @@ def extract_pdf_text(pdf_file: UploadFile) -> str:
                     except Exception:
                         # If encoding detection fails, try direct UTF-8 decoding
                         page_text = page_text.encode('utf-8', errors='ignore').decode('utf-8')
-                    text += page_text + "\n"
+                    text += page_text + "\n\f"
             except Exception as e:
                 logger.warning(f"Failed to extract text from page: {e}")
                 continue
@@ -240,8 +889,318 @@ def extract_pdf_text(pdf_file: UploadFile) -> str:
         logger.error(f"PDF extraction failed: {e}")
         raise HTTPException(status_code=400, detail=f"Failed to process PDF: {str(e)}")
 
+def build_input_key(
+    materials: str,
+    num_questions: int,
+    course_id: Optional[str] = None,
+    use_question_bank: bool = True
+) -> str:
+    """Fingerprint generation inputs, ignoring whitespace-only differences"""
+    normalized = " ".join(materials.split())
+    digest = hashlib.sha256(
+        f"{num_questions}\x00{course_id or ''}\x00{int(use_question_bank)}\x00{normalized}".encode("utf-8")
+    )
+    return digest.hexdigest()
+
+def find_idempotent_task(idempotency_key: Optional[str], input_key: str) -> Optional[TaskSubmitResponse]:
+    """Return the task already submitted under this Idempotency-Key, if any"""
+    if not idempotency_key:
+        return None
+    
+    task_id = idempotency_keys.get(idempotency_key)
+    if task_id is None or task_id not in task_storage:
+        idempotency_keys.pop(idempotency_key, None)
+        return None
+    
+    task = task_storage[task_id]
+    if task.get("input_key") != input_key:
+        raise HTTPException(
+            status_code=422,
+            detail="Idempotency-Key was already used with a different request"
+        )
+    
+    logger.info(f"Idempotent replay of task {task_id}")
+    
+    return TaskSubmitResponse(
+        task_id=task_id,
+        status=task["status"],
+        message="Duplicate submission. Returning existing task."
+    )
+
+async def run_provider_generation(materials: str, num_questions: int, requirements: str = "") -> dict:
+    """Run one interactive provider generation while holding a concurrency slot"""
+    provider_load["interactive"] += 1
+    try:
+        async with generation_slots:
+            return await agenerate_questions(materials, num_questions, requirements)
+    finally:
+        provider_load["interactive"] -= 1
+
+def plan_shards(num_questions: int, num_chunks: int) -> List[Dict[str, Any]]:
+    """Split a large request into shards spread across material chunks and difficulty levels"""
+    num_shards = math.ceil(num_questions / SHARD_SIZE)
+    base, extra = divmod(num_questions, num_shards)
+    
+    shards = []
+    for i in range(num_shards):
+        shards.append({
+            "index": i,
+            "num_questions": base + (1 if i < extra else 0),
+            # Rotate chunks, and shift the difficulty each time the chunks wrap around
+            # so a reused chunk is asked for a different difficulty
+            "chunk": i % num_chunks,
+            "difficulty": DIFFICULTY_LEVELS[(i + i // num_chunks) % len(DIFFICULTY_LEVELS)],
+            "status": TaskStatus.PENDING,
+            "attempts": 0,
+            "questions": [],
+            # Accepted questions parsed from well-formed responses, safe to bank
+            "bankable": [],
+            "error_message": None
+        })
+    return shards
+
+def merge_shard_questions(shards: List[Dict[str, Any]]) -> List[dict]:
+    """Combine questions from completed shards, dropping exact duplicates"""
+    seen = set()
+    questions = []
+    for shard in shards:
+        if shard["status"] != TaskStatus.COMPLETED:
+            continue
+        for question in shard["questions"]:
+            key = " ".join(str(question.get("question", "")).casefold().split())
+            if key in seen:
+                continue
+            seen.add(key)
+            questions.append(question)
+    return questions
+
+async def generate_distinct_questions(
+    materials: str,
+    num_questions: int,
+    requirements: str,
+    accepted: List[dict],
+    paper_index: NearDuplicateIndex,
+    history_index: Optional[NearDuplicateIndex],
+    bankable: Optional[List[dict]] = None
+):
+    """Generate questions into `accepted`, re-requesting only the slots dropped as near-duplicates.
+    
+    Accepted questions that did not come from the fallback parser are also
+    added to `bankable`.
+    """
+    dropped: List[str] = []
+    for _ in range(1 + DEDUP_MAX_REGENERATIONS):
+        missing = num_questions - len(accepted)
+        if missing <= 0:
+            return
+        
+        extra = ""
+        if dropped:
+            extra = "\nDo not repeat or paraphrase any of these existing questions:\n" + "".join(
+                f"- {text}\n" for text in dropped[-10:]
+            )
+        result = await run_provider_generation(materials, missing, requirements + extra)
+        
+        dropped_before = len(dropped)
+        for question in result["questions"][:missing]:
+            if accept_question(question, paper_index, history_index):
+                accepted.append(question)
+                if bankable is not None and not result.get("fallback"):
+                    bankable.append(question)
+            else:
+                dropped.append(str(question.get("question", "")))
+        
+        if len(dropped) == dropped_before:
+            # Nothing was dropped this round; a short response is not retried
+            return
+        logger.info(f"Dropped {len(dropped) - dropped_before} near-duplicate questions, regenerating")
+
+async def run_sharded_generation(
+    chunks: List[str],
+    shards: List[Dict[str, Any]],
+    paper_index: NearDuplicateIndex,
+    history_index: Optional[NearDuplicateIndex]
+) -> dict:
+    """Generate all shards in parallel, retrying only the shards that fail.
+    
+    Shard dicts are updated in place so callers can expose completed shards
+    as partial results while the rest are still running.
+    """
+    async def run_shard(shard: Dict[str, Any]):
+        requirements = (
+            f"\nAll {shard['num_questions']} questions must have difficulty \"{shard['difficulty']}\". "
+            f"This is part {shard['index'] + 1} of {len(shards)} of a larger exam; "
+            f"focus on aspects of the materials a different part is unlikely to cover.\n"
+        )
+        while shard["attempts"] < SHARD_MAX_ATTEMPTS:
+            shard["status"] = TaskStatus.PROCESSING
+            shard["attempts"] += 1
+            try:
+                # Questions accepted by an earlier failed attempt are kept
+                await generate_distinct_questions(
+                    chunks[shard["chunk"]], shard["num_questions"], requirements,
+                    shard["questions"], paper_index, history_index, shard["bankable"]
+                )
+                shard["status"] = TaskStatus.COMPLETED
+                shard["error_message"] = None
+                return
+            except Exception as e:
+                shard["error_message"] = str(e)
+                logger.warning(f"Shard {shard['index']} attempt {shard['attempts']} failed: {e}")
+        shard["status"] = TaskStatus.FAILED
+    
+    await asyncio.gather(*(run_shard(shard) for shard in shards))
+    
+    questions = merge_shard_questions(shards)
+    failed = [shard for shard in shards if shard["status"] == TaskStatus.FAILED]
+    if not questions:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Generation failed: all {len(shards)} shards failed ({failed[0]['error_message']})"
+        )
+    
+    return {
+        "questions": questions,
+        "failed_shards": len(failed)
+    }
+
+async def run_generation(
+    materials: str,
+    num_questions: int,
+    shards: List[Dict[str, Any]],
+    banked: List[dict],
+    course_id: Optional[str] = None,
+    use_question_bank: bool = True
+) -> dict:
+    """Serve what the question bank can, then generate the remainder.
+    
+    Bank hits are appended to `banked` and larger remainders are split into
+    shards appended to `shards`, so waiting tasks can follow their progress.
+    """
+    start_time = datetime.now()
+    # Shards inherit this context, so every provider call of the generation is recorded here
+    calls: List[Dict[str, Any]] = []
+    current_call_usage.set(calls)
+    paper_index = NearDuplicateIndex()
+    history_index = await get_course_history(course_id)
+    chunks = text_splitter.split_text(materials) or [materials]
+    fingerprints = [chunk_fingerprint(chunk) for chunk in chunks]
+    
+    # Banked questions from overlapping source chunks go through the same duplicate filter
+    banked_ids: List[int] = []
+    if question_bank is not None and use_question_bank:
+        candidates = await asyncio.to_thread(question_bank.find_by_sources, fingerprints, num_questions * 4)
+        for question_id, question in candidates:
+            if len(banked) >= num_questions:
+                break
+            if accept_question(question, paper_index, history_index):
+                banked.append(question)
+                banked_ids.append(question_id)
+    
+    remaining = num_questions - len(banked)
+    new_entries: List[tuple] = []
+    if remaining > SHARD_SIZE:
+        shards.extend(plan_shards(remaining, len(chunks)))
+        logger.info(f"Generating {remaining} questions in {len(shards)} shards")
+        result = await run_sharded_generation(chunks, shards, paper_index, history_index)
+        for shard in shards:
+            new_entries.extend((question, [fingerprints[shard["chunk"]]]) for question in shard["bankable"])
+    elif remaining > 0:
+        questions: List[dict] = []
+        bankable: List[dict] = []
+        await generate_distinct_questions(materials, remaining, "", questions, paper_index, history_index, bankable)
+        # build_prompt only sends the first chunk of oversized materials
+        sources = fingerprints[:1] if len(materials) > MAX_PROMPT_MATERIALS else fingerprints
+        new_entries = [(question, sources) for question in bankable]
+        result = {"questions": questions}
+    else:
+        result = {"questions": []}
+    
+    result["questions"] = banked + result["questions"]
+    result["generation_time"] = (datetime.now() - start_time).total_seconds()
+    result["near_duplicates_dropped"] = paper_index.rejected
+    result["bank_hits"] = len(banked)
+    result["bank_hit_ratio"] = round(len(banked) / num_questions, 3) if num_questions else 0.0
+    result["usage"] = summarize_call_usage(calls)
+    generation_stats["bank_hits"] += len(banked)
+    generation_stats["questions_requested"] += num_questions
+    
+    # Remember this paper's questions so later papers for the course avoid them
+    if course_id:
+        history = question_history.setdefault(course_id, NearDuplicateIndex())
+        for signature in paper_index.signatures:
+            history.add(signature)
+    
+    new_entries = valid_bank_entries(new_entries)
+    if question_bank is not None and new_entries:
+        await asyncio.to_thread(question_bank.add, new_entries, course_id)
+    if question_bank is not None and course_id and banked_ids:
+        # Bank hits are issued to the course too, so a restart does not serve them again
+        await asyncio.to_thread(question_bank.record_issued, course_id, banked_ids)
+    
+    return result
+
+def release_inflight_generation(input_key: str, shared: Dict[str, Any]):
+    """Drop a shared generation from the in-flight table if it is still the current one"""
+    if inflight_generations.get(input_key) is shared:
+        del inflight_generations[input_key]
+
+async def run_coalesced_generation(task_id: str, materials: str, num_questions: int) -> dict:
+    """Run a generation, sharing one in-flight call between identical tasks"""
+    input_key = task_storage[task_id]["input_key"]
+    shared = inflight_generations.get(input_key)
+    
+    if shared is not None:
+        # Identical generation already running: wait for it instead of calling the provider
+        task_storage[task_id]["coalesced"] = True
+        task_storage[task_id]["progress"] = "Waiting for identical in-flight generation..."
+        logger.info(f"Task {task_id} coalesced onto in-flight generation {input_key[:12]}")
+    else:
+        shards: List[Dict[str, Any]] = []
+        banked: List[dict] = []
+        shared = {
+            "task": asyncio.create_task(run_generation(
+                materials,
+                num_questions,
+                shards,
+                banked,
+                task_storage[task_id].get("course_id"),
+                task_storage[task_id].get("use_question_bank", True)
+            )),
+            "shards": shards,
+            "banked": banked,
+            "waiters": 0
+        }
+        inflight_generations[input_key] = shared
+        shared["task"].add_done_callback(lambda _: release_inflight_generation(input_key, shared))
+    
+    # Share bank hits and shard progress so every waiting task can expose partial results
+    task_storage[task_id]["shards"] = shared["shards"]
+    task_storage[task_id]["banked"] = shared["banked"]
+    shared["waiters"] += 1
+    try:
+        # Shield so one waiter being cancelled does not cancel the call for the others
+        result = await asyncio.shield(shared["task"])
+    finally:
+        shared["waiters"] -= 1
+        if shared["waiters"] == 0 and not shared["task"].done():
+            # Last waiter gone: abort the provider call and free its slot
+            release_inflight_generation(input_key, shared)
+            shared["task"].cancel()
+    
+    if task_storage[task_id].get("coalesced"):
+        # The shared generation may have made anywhere from zero to many provider calls
+        generation_stats["calls_saved_by_coalescing"] += len(result.get("usage", {}).get("calls", []))
+    
+    # Each waiter gets its own copy so tasks never share mutable result state
+    return copy.deepcopy(result)
+
 async def process_generation_task(task_id: str, materials: str, num_questions: int):
     """Background task for processing question generation"""
+    if task_id not in task_storage or task_storage[task_id]["status"] == TaskStatus.CANCELLED:
+        logger.info(f"Task {task_id} was cancelled before it started")
+        return
+    
     try:
         # Update task status to processing
         task_storage[task_id]["status"] = TaskStatus.PROCESSING
@@ -250,17 +1209,42 @@ async def process_generation_task(task_id: str, materials: str, num_questions: i
         
         logger.info(f"Starting task {task_id}")
         
-        # Generate questions
-        result = await asyncio.to_thread(generate_questions, materials, num_questions)
+        # Generate questions in a separate asyncio task so it can be cancelled
+        running_tasks[task_id] = asyncio.create_task(
+            run_coalesced_generation(task_id, materials, num_questions)
+        )
+        result = await running_tasks[task_id]
+        
+        # Cancelled after the worker finished but before this coroutine resumed:
+        # the client was already told the task is cancelled, so keep it that way
+        if task_storage.get(task_id, {}).get("status") == TaskStatus.CANCELLED:
+            logger.info(f"Task {task_id} cancelled")
+            return
         
         # Update task as completed
         task_storage[task_id]["status"] = TaskStatus.COMPLETED
         task_storage[task_id]["result"] = result
         task_storage[task_id]["completed_at"] = datetime.now()
         task_storage[task_id]["updated_at"] = datetime.now()
+        if result.get("failed_shards"):
+            task_storage[task_id]["progress"] = (
+                f"Completed with {result['failed_shards']} failed shards "
+                f"({len(result['questions'])} questions)"
+            )
+        else:
+            task_storage[task_id]["progress"] = "Completed"
         
         logger.info(f"Task {task_id} completed successfully")
         
+    except asyncio.CancelledError:
+        if task_id in task_storage and task_storage[task_id]["status"] == TaskStatus.CANCELLED:
+            # Cancelled on request; the worker has already been torn down
+            logger.info(f"Task {task_id} cancelled")
+            return
+        # Cancelled from outside (e.g. server shutdown)
+        if task_id in task_storage:
+            mark_task_cancelled(task_id, "Task cancelled by server")
+        raise
     except Exception as e:
         # Update task as failed
         error_msg = str(e)
@@ -269,116 +1253,575 @@ async def process_generation_task(task_id: str, materials: str, num_questions: i
         task_storage[task_id]["updated_at"] = datetime.now()
         
         logger.error(f"Task {task_id} failed: {error_msg}")
+    finally:
+        running_tasks.pop(task_id, None)
+
+def mark_task_cancelled(task_id: str, reason: str):
+    """Record a task as cancelled"""
+    task = task_storage[task_id]
+    task["status"] = TaskStatus.CANCELLED
+    task["error_message"] = reason
+    task["progress"] = "Cancelled"
+    task["completed_at"] = datetime.now()
+    task["updated_at"] = datetime.now()
+
+def cancel_task(task_id: str, reason: str) -> bool:
+    """Cancel a pending or processing task. Returns False if it already finished."""
+    task = task_storage[task_id]
+    if task["status"] not in [TaskStatus.PENDING, TaskStatus.PROCESSING]:
+        return False
+    
+    mark_task_cancelled(task_id, reason)
+    
+    # A pending task is skipped when its background job starts; a processing one is interrupted
+    worker = running_tasks.get(task_id)
+    if worker is not None:
+        worker.cancel()
+    
+    logger.info(f"Task {task_id} cancellation requested: {reason}")
+    return True
+
+async def cancel_unpolled_tasks():
+    """Periodically cancel active tasks whose client stopped polling"""
+    interval = max(1, min(30, TASK_POLL_TIMEOUT // 2))
+    while True:
+        await asyncio.sleep(interval)
+        now = datetime.now()
+        for task_id, task in list(task_storage.items()):
+            idle = (now - task.get("last_polled_at", task["created_at"])).total_seconds()
+            if idle > TASK_POLL_TIMEOUT:
+                cancel_task(task_id, f"Task not polled for {int(idle)} seconds")
+
+def build_prompt(materials: str, num_questions: int, requirements: str = ""):
+    """Build the generation prompt for PROMPT_VERSION, trimming oversized materials.
+    
+    Returns a string for single-message templates, or the static system
+    message followed by the per-call user message.
+    """
+    # Split text if too long
+    if len(materials) > MAX_PROMPT_MATERIALS:
+        chunks = text_splitter.split_text(materials)
+        materials = chunks[0]  # Use first chunk
+    
+    spec = PROMPT_TEMPLATES[PROMPT_VERSION]
+    text = spec["template"].format(
+        materials=materials,
+        num_questions=num_questions,
+        requirements=requirements
+    )
+    if spec["system"] is None:
+        return text
+    return [spec["system"], HumanMessage(content=text)]
+
+def parse_generation_response(response, materials: str, num_questions: int, generation_time: float) -> dict:
+    """Parse the LLM response into a generation result dict"""
+    try:
+        import json
+        # Log the raw response for debugging
+        logger.info(f"AI Raw Response: {response.content[:500]}...")
+        
+        # Try to extract JSON from response if it's wrapped in text
+        content = response.content.strip()
+        
+        # Look for JSON block in the response
+        if "```json" in content:
+            start = content.find("```json") + 7
+            end = content.find("```", start)
+            if end != -1:
+                content = content[start:end].strip()
+        elif "{" in content and "}" in content:
+            start = content.find("{")
+            end = content.rfind("}") + 1
+            content = content[start:end]
+        
+        result = json.loads(content)
+        result["generation_time"] = generation_time
+        return result
+    
+    except (json.JSONDecodeError, ValueError) as e:
+        logger.error(f"JSON parsing failed: {e}")
+        logger.error(f"Raw response: {response.content}")
+        
+        # Try to parse the response manually
+        content = response.content
+        questions = []
+        
+        # Simple pattern matching for questions and answers
+        lines = content.split('\n')
+        current_question = ""
+        current_answer = ""
+        current_difficulty = "medium"
+        current_topic = "general"
+        current_explanation = "This question covers fundamental concepts from the provided materials."
+        
+        for line in lines:
+            line = line.strip()
+            if line.lower().startswith(('question', 'q:', 'q.', '**question')):
+                if current_question:
+                    questions.append({
+                        "question": current_question,
+                        "answer": current_answer or "Answer based on the provided materials",
+                        "difficulty": current_difficulty,
+                        "topic": current_topic,
+                        "explanation": current_explanation
+                    })
+                current_question = line
+                current_answer = ""
+                current_explanation = "This question covers fundamental concepts from the provided materials."
+            elif line.lower().startswith(('answer', 'a:', 'a.', '**answer')):
+                current_answer = line
+            elif line.lower().startswith(('explanation', 'explain', 'concept')):
+                current_explanation = line
+            elif line and current_question and not current_answer:
+                current_answer = line
+        
+        # Add the last question
+        if current_question:
+            questions.append({
+                "question": current_question,
+                "answer": current_answer or "Answer based on the provided materials",
+                "difficulty": current_difficulty,
+                "topic": current_topic,
+                "explanation": current_explanation
+            })
+        
+        # If no questions found, create basic ones
+        if not questions:
+            questions = [{
+                "question": f"Based on the materials about {materials[:50]}..., explain the key concepts.",
+                "answer": f"The materials discuss: {materials[:200]}...",
+                "difficulty": "medium",
+                "topic": "general",
+                "explanation": f"This question tests understanding of the core concepts presented in the educational materials. The topic involves {materials[:100]}... and is fundamental to comprehending the subject matter."
+            }]
+        
+        return {
+            "questions": questions[:num_questions],
+            "generation_time": generation_time,
+            # Marks questions that must not be stored in the question bank
+            "fallback": True
+        }
+
+def record_provider_call():
+    """Count a provider call and remember when it happened"""
+    generation_stats["provider_calls"] += 1
+    now = time.monotonic()
+    provider_call_times.append(now)
+    while provider_call_times and provider_call_times[0] < now - 60:
+        provider_call_times.popleft()
+
+def extract_token_usage(response) -> Dict[str, int]:
+    """Prompt, cached-prompt and completion token counts reported by the provider"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        details = usage.get("input_token_details") or {}
+        return {
+            "prompt_tokens": usage.get("input_tokens") or 0,
+            "cached_prompt_tokens": details.get("cache_read") or 0,
+            "completion_tokens": usage.get("output_tokens") or 0
+        }
+    
+    # Older clients only expose the raw OpenAI usage block
+    token_usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+    details = token_usage.get("prompt_tokens_details") or {}
+    return {
+        "prompt_tokens": token_usage.get("prompt_tokens") or 0,
+        "cached_prompt_tokens": details.get("cached_tokens") or 0,
+        "completion_tokens": token_usage.get("completion_tokens") or 0
+    }
+
+def record_call_usage(response, latency: float):
+    """Add a provider call's token usage to the global totals and the current generation"""
+    record = {"prompt_version": PROMPT_VERSION, "latency": round(latency, 3), **extract_token_usage(response)}
+    for key in ["prompt_tokens", "cached_prompt_tokens", "completion_tokens"]:
+        generation_stats[key] += record[key]
+    
+    calls = current_call_usage.get()
+    if calls is not None:
+        calls.append(record)
+
+def summarize_call_usage(calls: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Totals, prefix-cache hit ratio and estimated cost for a generation's provider calls"""
+    prompt_tokens = sum(call["prompt_tokens"] for call in calls)
+    cached = sum(call["cached_prompt_tokens"] for call in calls)
+    completion_tokens = sum(call["completion_tokens"] for call in calls)
+    
+    cost = None
+    if PROMPT_TOKEN_PRICE or CACHED_PROMPT_TOKEN_PRICE or COMPLETION_TOKEN_PRICE:
+        cost = round((
+            (prompt_tokens - cached) * PROMPT_TOKEN_PRICE
+            + cached * CACHED_PROMPT_TOKEN_PRICE
+            + completion_tokens * COMPLETION_TOKEN_PRICE
+        ) / 1_000_000, 6)
+    
+    return {
+        "calls": calls,
+        "prompt_tokens": prompt_tokens,
+        "cached_prompt_tokens": cached,
+        "completion_tokens": completion_tokens,
+        "cache_hit_ratio": round(cached / prompt_tokens, 3) if prompt_tokens else None,
+        "total_latency": round(sum(call["latency"] for call in calls), 3),
+        "estimated_cost": cost
+    }
+
+def has_spare_provider_capacity() -> bool:
+    """True when no interactive work is active and rate-limit headroom remains"""
+    if provider_load["interactive"] > 0 or running_tasks:
+        return False
+    if PROVIDER_RATE_LIMIT_RPM > 0:
+        recent = len([t for t in provider_call_times if t >= time.monotonic() - 60])
+        if recent >= PROVIDER_RATE_LIMIT_RPM * PREGENERATION_MAX_RATE_SHARE:
+            return False
+    return True
+
+async def run_pregeneration_chunk(job: Dict[str, Any], chunk_index: int) -> bool:
+    """Generate and bank reserve questions for one chunk.
+    
+    Returns False if the call was abandoned to make room for interactive work.
+    """
+    async with generation_slots:
+        call = asyncio.create_task(
+            agenerate_questions(job["chunks"][chunk_index], job["questions_per_chunk"])
+        )
+        while not call.done():
+            await asyncio.wait([call], timeout=PREGENERATION_POLL_INTERVAL)
+            if not call.done() and not has_spare_provider_capacity():
+                # Interactive work arrived: abort the provider request and free the slot
+                call.cancel()
+                generation_stats["pregeneration_yields"] += 1
+                job["yields"] += 1
+                logger.info(f"Pre-generation job {job['job_id']} yielded to interactive work")
+                return False
+    
+    result = call.result()
+    if result.get("fallback"):
+        # Scraped or placeholder questions from a malformed response must not be banked
+        raise ValueError("Provider returned a malformed response")
+    accepted = [
+        question for question in result["questions"][:job["questions_per_chunk"]]
+        if accept_question(question, job["index"], None)
+    ]
+    fingerprint = job["fingerprints"][chunk_index]
+    entries = valid_bank_entries([(question, [fingerprint]) for question in accepted])
+    await asyncio.to_thread(question_bank.add, entries)
+    job["questions_banked"] += len(entries)
+    return True
+
+async def run_pregeneration_worker():
+    """Work through queued pre-generation jobs whenever the provider is idle"""
+    while True:
+        if not pregeneration_queue or not has_spare_provider_capacity():
+            await asyncio.sleep(PREGENERATION_POLL_INTERVAL)
+            continue
+        
+        job = pregeneration_queue[0]
+        chunk_index = job["pending_chunks"][0]
+        job["status"] = TaskStatus.PROCESSING
+        job["updated_at"] = datetime.now()
+        try:
+            if await run_pregeneration_chunk(job, chunk_index):
+                job["pending_chunks"].pop(0)
+                job["chunks_completed"] += 1
+        except Exception as e:
+            # A failing chunk is skipped rather than retried forever
+            job["pending_chunks"].pop(0)
+            job["chunks_failed"] += 1
+            job["error_message"] = str(e)
+            logger.warning(f"Pre-generation job {job['job_id']} chunk {chunk_index} failed: {e}")
+        
+        job["updated_at"] = datetime.now()
+        if not job["pending_chunks"]:
+            pregeneration_queue.popleft()
+            job["status"] = TaskStatus.COMPLETED if job["chunks_completed"] else TaskStatus.FAILED
+            job["completed_at"] = datetime.now()
+            # The job's chunk texts are no longer needed
+            job["chunks"] = []
+            logger.info(f"Pre-generation job {job['job_id']} finished: {job['questions_banked']} questions banked")
+
+def submit_pregeneration(materials: str, questions_per_chunk: int, source: str, filename: Optional[str] = None) -> Dict[str, Any]:
+    """Queue reserve generation for the chunks of `materials` not already in the bank"""
+    if question_bank is None:
+        raise HTTPException(status_code=404, detail="Question bank is disabled")
+    
+    chunks = text_splitter.split_text(materials) or [materials]
+    fingerprints = [chunk_fingerprint(chunk) for chunk in chunks]
+    pending = [
+        i for i, fingerprint in enumerate(fingerprints)
+        if question_bank.count_by_source(fingerprint) < questions_per_chunk
+    ]
+    
+    job_id = str(uuid.uuid4())
+    job = {
+        "job_id": job_id,
+        "status": TaskStatus.PENDING if pending else TaskStatus.COMPLETED,
+        "created_at": datetime.now(),
+        "updated_at": datetime.now(),
+        "completed_at": None if pending else datetime.now(),
+        "source": source,
+        "filename": filename,
+        "questions_per_chunk": questions_per_chunk,
+        "chunks": chunks if pending else [],
+        "fingerprints": fingerprints,
+        "pending_chunks": pending,
+        "chunks_total": len(chunks),
+        "chunks_already_banked": len(chunks) - len(pending),
+        "chunks_completed": 0,
+        "chunks_failed": 0,
+        "questions_banked": 0,
+        "yields": 0,
+        "error_message": None,
+        # Keeps the reserve free of near-duplicates across the job's chunks
+        "index": NearDuplicateIndex()
+    }
+    pregeneration_jobs[job_id] = job
+    if pending:
+        pregeneration_queue.append(job)
+    
+    logger.info(f"Pre-generation job {job_id} queued: {len(pending)}/{len(chunks)} chunks to generate")
+    return job
 
 def generate_questions(materials: str, num_questions: int) -> dict:
     """Generate questions using LangChain"""
     try:
-        # Split text if too long
-        if len(materials) > 8000:
-            chunks = text_splitter.split_text(materials)
-            materials = chunks[0]  # Use first chunk
-        
         # Generate prompt
-        prompt = prompt_template.format(
-            materials=materials,
-            num_questions=num_questions
-        )
+        prompt = build_prompt(materials, num_questions)
         
         # Call LLM
         start_time = datetime.now()
-        response = get_llm().invoke(prompt)
+        record_provider_call()
+        provider_load["interactive"] += 1
+        try:
+            response = get_llm().invoke(prompt)
+        finally:
+            provider_load["interactive"] -= 1
+        generation_time = (datetime.now() - start_time).total_seconds()
+        record_call_usage(response, generation_time)
+        
+        return parse_generation_response(response, materials, num_questions, generation_time)
+    except Exception as e:
+        logger.error(f"Question generation failed: {e}")
+        raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
+
+async def agenerate_questions(materials: str, num_questions: int, requirements: str = "") -> dict:
+    """Generate questions using the async LangChain client.
+    
+    Cancelling the awaiting task aborts the in-flight provider request.
+    """
+    try:
+        prompt = build_prompt(materials, num_questions, requirements)
+        
+        start_time = datetime.now()
+        record_provider_call()
+        response = await get_llm().ainvoke(prompt)
         generation_time = (datetime.now() - start_time).total_seconds()
+        record_call_usage(response, generation_time)
         
-        # Parse response
-        try:
-            import json
-            # Log the raw response for debugging
-            logger.info(f"AI Raw Response: {response.content[:500]}...")
-            
-            # Try to extract JSON from response if it's wrapped in text
-            content = response.content.strip()
-            
-            # Look for JSON block in the response
-            if "```json" in content:
-                start = content.find("```json") + 7
-                end = content.find("```", start)
-                if end != -1:
-                    content = content[start:end].strip()
-            elif "{" in content and "}" in content:
-                start = content.find("{")
-                end = content.rfind("}") + 1
-                content = content[start:end]
-            
-            result = json.loads(content)
-            result["generation_time"] = generation_time
-            return result
-            
-        except (json.JSONDecodeError, ValueError) as e:
-            logger.error(f"JSON parsing failed: {e}")
-            logger.error(f"Raw response: {response.content}")
-            
-            # Try to parse the response manually
-            content = response.content
-            questions = []
-            
-            # Simple pattern matching for questions and answers
-            lines = content.split('\n')
-            current_question = ""
-            current_answer = ""
-            current_difficulty = "medium"
-            current_topic = "general"
-            current_explanation = "This question covers fundamental concepts from the provided materials."
-            
-            for line in lines:
-                line = line.strip()
-                if line.lower().startswith(('question', 'q:', 'q.', '**question')):
-                    if current_question:
-                        questions.append({
-                            "question": current_question,
-                            "answer": current_answer or "Answer based on the provided materials",
-                            "difficulty": current_difficulty,
-                            "topic": current_topic,
-                            "explanation": current_explanation
-                        })
-                    current_question = line
-                    current_answer = ""
-                    current_explanation = "This question covers fundamental concepts from the provided materials."
-                elif line.lower().startswith(('answer', 'a:', 'a.', '**answer')):
-                    current_answer = line
-                elif line.lower().startswith(('explanation', 'explain', 'concept')):
-                    current_explanation = line
-                elif line and current_question and not current_answer:
-                    current_answer = line
-            
-            # Add the last question
-            if current_question:
-                questions.append({
-                    "question": current_question,
-                    "answer": current_answer or "Answer based on the provided materials",
-                    "difficulty": current_difficulty,
-                    "topic": current_topic,
-                    "explanation": current_explanation
-                })
-            
-            # If no questions found, create basic ones
-            if not questions:
-                questions = [{
-                    "question": f"Based on the materials about {materials[:50]}..., explain the key concepts.",
-                    "answer": f"The materials discuss: {materials[:200]}...",
-                    "difficulty": "medium",
-                    "topic": "general",
-                    "explanation": f"This question tests understanding of the core concepts presented in the educational materials. The topic involves {materials[:100]}... and is fundamental to comprehending the subject matter."
-                }]
-            
-            return {
-                "questions": questions[:num_questions],
-                "generation_time": generation_time
-            }
-            
+        return parse_generation_response(response, materials, num_questions, generation_time)
     except Exception as e:
         logger.error(f"Question generation failed: {e}")
         raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
 
+@app.on_event("startup")
+async def start_poll_watchdog():
+    if TASK_POLL_TIMEOUT > 0:
+        asyncio.create_task(cancel_unpolled_tasks())
+        logger.info(f"Auto-cancelling tasks not polled within {TASK_POLL_TIMEOUT}s")
+
+# Event-loop lag state, shared between the sampling coroutine and the watchdog thread
+loop_lag_samples: deque = deque(maxlen=2000)
+loop_stalls: deque = deque(maxlen=50)
+loop_monitor_state: Dict[str, Any] = {
+    "heartbeat": 0.0,
+    "loop": None,
+    "thread_id": None,
+    "watchdog": None,
+    "pending_stall": None,
+    "stalls_total": 0
+}
+
+def find_blocking_endpoint(frame) -> Optional[Any]:
+    """Return the route endpoint whose frame is on the blocked stack, if any"""
+    endpoints = {
+        route.endpoint.__code__: route.endpoint
+        for route in app.routes
+        if hasattr(getattr(route, "endpoint", None), "__code__")
+    }
+    while frame is not None:
+        if frame.f_code in endpoints:
+            return endpoints[frame.f_code]
+        frame = frame.f_back
+    return None
+
+def watch_event_loop():
+    """Watchdog thread: record the loop's stack while it is blocked"""
+    threshold = EVENT_LOOP_STALL_THRESHOLD_MS / 1000
+    while True:
+        time.sleep(threshold / 4)
+        loop = loop_monitor_state["loop"]
+        if loop is None or not loop.is_running():
+            continue
+        stalled_for = time.monotonic() - loop_monitor_state["heartbeat"] - EVENT_LOOP_SAMPLE_INTERVAL
+        if stalled_for < threshold or loop_monitor_state["pending_stall"] is not None:
+            continue
+        
+        frame = sys._current_frames().get(loop_monitor_state["thread_id"])
+        if frame is None:
+            continue
+        endpoint = find_blocking_endpoint(frame)
+        stall = {
+            "detected_at": time.monotonic(),
+            "timestamp": datetime.now().isoformat(),
+            "duration_ms": round(stalled_for * 1000, 1),
+            "endpoint": endpoint,
+            "route": next(
+                (route.path for route in app.routes if getattr(route, "endpoint", None) is endpoint),
+                None
+            ) if endpoint else None,
+            "stack": traceback.format_stack(frame, limit=12)
+        }
+        loop_monitor_state["pending_stall"] = stall
+        loop_monitor_state["stalls_total"] += 1
+        loop_stalls.append(stall)
+        logger.warning(
+            f"Event loop blocked for over {stall['duration_ms']}ms "
+            f"(route: {stall['route'] or 'background'})\n{''.join(stall['stack'][-4:])}"
+        )
+
+async def sample_event_loop_lag():
+    """Measure how late the loop wakes up from a fixed sleep"""
+    loop_monitor_state["loop"] = asyncio.get_running_loop()
+    loop_monitor_state["thread_id"] = threading.get_ident()
+    loop_monitor_state["pending_stall"] = None
+    while True:
+        loop_monitor_state["heartbeat"] = time.monotonic()
+        await asyncio.sleep(EVENT_LOOP_SAMPLE_INTERVAL)
+        lag = time.monotonic() - loop_monitor_state["heartbeat"] - EVENT_LOOP_SAMPLE_INTERVAL
+        loop_lag_samples.append(max(0.0, lag) * 1000)
+        
+        stall = loop_monitor_state["pending_stall"]
+        if stall is not None:
+            # The loop is running again: record how long the stall really lasted
+            stall["duration_ms"] = round(lag * 1000, 1)
+            loop_monitor_state["pending_stall"] = None
+
+def lag_percentiles() -> Dict[str, Optional[float]]:
+    """Percentiles of recent event-loop lag samples in milliseconds"""
+    samples = sorted(loop_lag_samples)
+    if not samples:
+        return {"p50": None, "p90": None, "p99": None, "max": None}
+    
+    def percentile(q: float) -> float:
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))], 2)
+    
+    return {
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "max": round(samples[-1], 2)
+    }
+
+@app.on_event("startup")
+async def start_pregeneration_worker():
+    if question_bank is not None:
+        asyncio.create_task(run_pregeneration_worker())
+
+@app.on_event("startup")
+async def start_event_loop_monitor():
+    if EVENT_LOOP_MONITOR:
+        asyncio.create_task(sample_event_loop_lag())
+        if loop_monitor_state["watchdog"] is None:
+            loop_monitor_state["watchdog"] = threading.Thread(
+                target=watch_event_loop, name="event-loop-watchdog", daemon=True
+            )
+            loop_monitor_state["watchdog"].start()
+        logger.info(f"Event loop monitor started (stall threshold {EVENT_LOOP_STALL_THRESHOLD_MS}ms)")
+
+@app.middleware("http")
+async def detect_blocking_handlers(request: Request, call_next):
+    """In strict mode, fail requests whose handler blocked the event loop"""
+    started = time.monotonic()
+    response = await call_next(request)
+    
+    if EVENT_LOOP_STRICT:
+        endpoint = request.scope.get("endpoint")
+        for stall in list(loop_stalls):
+            if stall["detected_at"] >= started and endpoint is not None and stall["endpoint"] is endpoint:
+                raise RuntimeError(
+                    f"{request.method} {request.url.path} blocked the event loop for "
+                    f"{stall['duration_ms']}ms:\n{''.join(stall['stack'])}"
+                )
+    
+    return response
+
+def json_default(value: Any) -> Any:
+    """Fallback conversions for the standard-library JSON encoder"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dump_json(data: Any) -> bytes:
+    """Serialize to compact JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, default=json_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick brotli or gzip from an Accept-Encoding header"""
+    accepted = set()
+    refused = set()
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            refused.add(name.strip().lower())
+            continue
+        accepted.add(name.strip().lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    # "*" only covers encodings the client did not explicitly refuse
+    if "gzip" in accepted or ("*" in accepted and "gzip" not in refused):
+        return "gzip"
+    return None
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or any(tag.removeprefix("W/") == etag for tag in candidates)
+
+def encoded_json_response(request: Request, body: bytes, cache: Optional[Dict[str, Any]] = None) -> Response:
+    """Serve a JSON body with a strong ETag, 304 on If-None-Match and optional compression.
+    
+    Compressed variants and the ETag are stored in `cache`, so a body that
+    never changes is hashed and compressed only once.
+    """
+    cache = cache if cache is not None else {}
+    if "etag" not in cache:
+        cache["etag"] = hashlib.sha1(body).hexdigest()
+        cache["bodies"] = {None: body}
+    
+    encoding = None
+    if len(body) >= COMPRESSION_MIN_SIZE:
+        encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+    
+    # Each encoding is a different representation and gets its own strong ETag
+    etag = f'"{cache["etag"]}-{encoding}"' if encoding else f'"{cache["etag"]}"'
+    headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    
+    if encoding not in cache["bodies"]:
+        if encoding == "br":
+            cache["bodies"][encoding] = brotli.compress(body)
+        else:
+            cache["bodies"][encoding] = gzip.compress(body, compresslevel=6)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    
+    return Response(content=cache["bodies"][encoding], media_type="application/json", headers=headers)
+
 # API Routes
 @app.get("/")
 async def root():
@@ -394,12 +1837,41 @@ async def health_check():
     return {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
-        "active_tasks": len([t for t in task_storage.values() if t["status"] in [TaskStatus.PENDING, TaskStatus.PROCESSING]])
+        "active_tasks": len([t for t in task_storage.values() if t["status"] in [TaskStatus.PENDING, TaskStatus.PROCESSING]]),
+        "provider_calls": generation_stats["provider_calls"],
+        "provider_calls_saved_by_coalescing": generation_stats["calls_saved_by_coalescing"],
+        "near_duplicates_dropped": generation_stats["near_duplicates_dropped"],
+        "question_bank_size": len(question_bank) if question_bank is not None else None,
+        "bank_hit_ratio": round(
+            generation_stats["bank_hits"] / generation_stats["questions_requested"], 3
+        ) if generation_stats["questions_requested"] else None,
+        "event_loop_lag_p99_ms": lag_percentiles()["p99"],
+        "prompt_version": PROMPT_VERSION,
+        "prompt_tokens": generation_stats["prompt_tokens"],
+        "cached_prompt_tokens": generation_stats["cached_prompt_tokens"],
+        "completion_tokens": generation_stats["completion_tokens"],
+        "pregeneration_queue": len(pregeneration_queue),
+        "pregeneration_yields": generation_stats["pregeneration_yields"]
     }
 
 @app.post("/tasks/generate", response_model=TaskSubmitResponse)
-async def submit_generation_task(input_data: QuestionInput, background_tasks: BackgroundTasks):
+async def submit_generation_task(
+    input_data: QuestionInput,
+    background_tasks: BackgroundTasks,
+    idempotency_key: Optional[str] = Header(None)
+):
     """Submit a question generation task"""
+    materials, normalization = await asyncio.to_thread(normalize_materials, input_data.materials)
+    input_key = build_input_key(
+        materials,
+        input_data.num_questions,
+        input_data.course_id,
+        input_data.use_question_bank
+    )
+    existing = find_idempotent_task(idempotency_key, input_key)
+    if existing:
+        return existing
+    
     try:
         # Generate task ID
         task_id = str(uuid.uuid4())
@@ -410,19 +1882,27 @@ async def submit_generation_task(input_data: QuestionInput, background_tasks: Ba
             "status": TaskStatus.PENDING,
             "created_at": datetime.now(),
             "updated_at": datetime.now(),
-            "materials": input_data.materials,
+            "materials": materials,
+            "normalization": normalization,
             "num_questions": input_data.num_questions,
+            "course_id": input_data.course_id,
+            "use_question_bank": input_data.use_question_bank,
             "progress": "Task submitted",
             "result": None,
             "error_message": None,
-            "completed_at": None
+            "completed_at": None,
+            "input_key": input_key,
+            "idempotency_key": idempotency_key,
+            "coalesced": False
         }
+        if idempotency_key:
+            idempotency_keys[idempotency_key] = task_id
         
         # Add background task
         background_tasks.add_task(
             process_generation_task,
             task_id,
-            input_data.materials,
+            materials,
             input_data.num_questions
         )
         
@@ -440,13 +1920,21 @@ async def submit_generation_task(input_data: QuestionInput, background_tasks: Ba
 async def submit_pdf_generation_task(
     background_tasks: BackgroundTasks,
     pdf_file: UploadFile = File(...),
-    num_questions: int = 5
+    num_questions: int = Query(5, ge=1, le=50),
+    course_id: Optional[str] = None,
+    use_question_bank: bool = True,
+    idempotency_key: Optional[str] = Header(None)
 ):
     """Submit a PDF question generation task"""
+    # Extract text from PDF and strip page boilerplate off the event loop
+    materials, normalization = await asyncio.to_thread(lambda: normalize_materials(extract_pdf_text(pdf_file)))
+    
+    input_key = build_input_key(materials, num_questions, course_id, use_question_bank)
+    existing = find_idempotent_task(idempotency_key, input_key)
+    if existing:
+        return existing
+    
     try:
-        # Extract text from PDF
-        materials = extract_pdf_text(pdf_file)
-        
         # Generate task ID
         task_id = str(uuid.uuid4())
         
@@ -457,14 +1945,22 @@ async def submit_pdf_generation_task(
             "created_at": datetime.now(),
             "updated_at": datetime.now(),
             "materials": materials,
+            "normalization": normalization,
             "num_questions": num_questions,
-            "progress": "PDF processed, task submitted",
+            "course_id": course_id,
+            "use_question_bank": use_question_bank,
+            "progress": f"PDF processed ({normalization['tokens_saved']} boilerplate tokens removed), task submitted",
             "result": None,
             "error_message": None,
             "completed_at": None,
             "source": "pdf",
-            "filename": pdf_file.filename
+            "filename": pdf_file.filename,
+            "input_key": input_key,
+            "idempotency_key": idempotency_key,
+            "coalesced": False
         }
+        if idempotency_key:
+            idempotency_keys[idempotency_key] = task_id
         
         # Add background task
         background_tasks.add_task(
@@ -491,43 +1987,82 @@ async def get_task_status(task_id: str):
         raise HTTPException(status_code=404, detail="Task not found")
     
     task = task_storage[task_id]
+    task["last_polled_at"] = datetime.now()
+    
+    progress = task.get("progress")
+    shards = task.get("shards")
+    shards_completed = None
+    if shards:
+        shards_completed = len([s for s in shards if s["status"] == TaskStatus.COMPLETED])
+        if task["status"] == TaskStatus.PROCESSING:
+            progress = f"{shards_completed}/{len(shards)} shards completed"
     
     return TaskStatusResponse(
         task_id=task_id,
         status=task["status"],
         created_at=task["created_at"],
         updated_at=task["updated_at"],
-        progress=task.get("progress"),
-        error_message=task.get("error_message")
+        progress=progress,
+        error_message=task.get("error_message"),
+        shards_total=len(shards) if shards else None,
+        shards_completed=shards_completed
     )
 
-@app.get("/tasks/{task_id}/result", response_model=TaskResultResponse)
-async def get_task_result(task_id: str):
-    """Get task result"""
-    if task_id not in task_storage:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
-    task = task_storage[task_id]
-    
+def build_task_result(task: Dict[str, Any]) -> TaskResultResponse:
+    """Build the result response model for a task"""
     # Convert result to GenerationResult if completed
     result = None
+    partial = False
     if task["status"] == TaskStatus.COMPLETED and task["result"]:
         result = GenerationResult(
             questions=[QuestionResponse(**q) for q in task["result"]["questions"]],
-            generation_time=task["result"]["generation_time"]
+            generation_time=task["result"]["generation_time"],
+            bank_hits=task["result"].get("bank_hits"),
+            bank_hit_ratio=task["result"].get("bank_hit_ratio")
+        )
+    elif task["status"] == TaskStatus.PROCESSING and (task.get("shards") or task.get("banked")):
+        # Expose bank hits and questions from shards that have already finished
+        partial = True
+        questions = task.get("banked", []) + merge_shard_questions(task.get("shards", []))
+        result = GenerationResult(
+            questions=[QuestionResponse(**q) for q in questions],
+            generation_time=(datetime.now() - task["created_at"]).total_seconds()
         )
     
     return TaskResultResponse(
-        task_id=task_id,
+        task_id=task["task_id"],
         status=task["status"],
         result=result,
+        partial=partial,
+        tokens_saved=task.get("normalization", {}).get("tokens_saved"),
+        usage=(task.get("result") or {}).get("usage") if task["status"] == TaskStatus.COMPLETED else None,
         error_message=task.get("error_message"),
         created_at=task["created_at"],
         completed_at=task.get("completed_at")
     )
 
+@app.get("/tasks/{task_id}/result", response_model=TaskResultResponse)
+async def get_task_result(task_id: str, request: Request):
+    """Get task result"""
+    if task_id not in task_storage:
+        raise HTTPException(status_code=404, detail="Task not found")
+    
+    task = task_storage[task_id]
+    task["last_polled_at"] = datetime.now()
+    
+    if task["status"] not in TERMINAL_STATUSES:
+        return build_task_result(task)
+    
+    # Finished tasks never change: serialize once and reuse the body on every poll
+    if "response_cache" not in task:
+        # Only cache once serialization succeeded, so a failure is retried on the next poll
+        task["response_body"] = dump_json(jsonable_encoder(build_task_result(task)))
+        task["response_cache"] = {}
+    
+    return encoded_json_response(request, task["response_body"], task["response_cache"])
+
 @app.get("/tasks")
-async def list_tasks(status: Optional[TaskStatus] = None, limit: int = 50):
+async def list_tasks(request: Request, status: Optional[TaskStatus] = None, limit: int = 50):
     """List all tasks with optional status filter"""
     tasks = []
     
@@ -541,18 +2076,108 @@ async def list_tasks(status: Optional[TaskStatus] = None, limit: int = 50):
                 "progress": task.get("progress"),
                 "num_questions": task.get("num_questions"),
                 "source": task.get("source", "text"),
-                "filename": task.get("filename")
+                "filename": task.get("filename"),
+                "coalesced": task.get("coalesced", False),
+                "bank_hit_ratio": (task.get("result") or {}).get("bank_hit_ratio"),
+                "tokens_saved": task.get("normalization", {}).get("tokens_saved")
             })
     
     # Sort by creation time (newest first)
     tasks.sort(key=lambda x: x["created_at"], reverse=True)
     
-    return {
+    return encoded_json_response(request, dump_json({
         "tasks": tasks[:limit],
         "total": len(tasks),
         "filtered_by_status": status.value if status else None
+    }))
+
+def pregeneration_status(job: Dict[str, Any]) -> PregenerationStatusResponse:
+    # Internal job fields (chunk texts, index) are ignored by the model
+    return PregenerationStatusResponse(**job)
+
+@app.post("/pregenerate", response_model=PregenerationStatusResponse)
+async def submit_pregeneration_job(input_data: PregenerationInput):
+    """Queue low-priority reserve question generation for course materials"""
+    materials, _ = await asyncio.to_thread(normalize_materials, input_data.materials)
+    job = await asyncio.to_thread(submit_pregeneration, materials, input_data.questions_per_chunk, "text")
+    return pregeneration_status(job)
+
+@app.post("/pregenerate/pdf", response_model=PregenerationStatusResponse)
+async def submit_pdf_pregeneration_job(
+    pdf_file: UploadFile = File(...),
+    questions_per_chunk: int = Query(5, ge=1, le=10)
+):
+    """Queue low-priority reserve question generation for a PDF"""
+    materials, _ = await asyncio.to_thread(lambda: normalize_materials(extract_pdf_text(pdf_file)))
+    job = await asyncio.to_thread(
+        submit_pregeneration, materials, questions_per_chunk, "pdf", pdf_file.filename
+    )
+    return pregeneration_status(job)
+
+@app.get("/pregenerate/{job_id}", response_model=PregenerationStatusResponse)
+async def get_pregeneration_status(job_id: str):
+    """Get pre-generation job progress"""
+    if job_id not in pregeneration_jobs:
+        raise HTTPException(status_code=404, detail="Pre-generation job not found")
+    return pregeneration_status(pregeneration_jobs[job_id])
+
+@app.get("/metrics/event-loop")
+async def event_loop_metrics():
+    """Event-loop lag percentiles and recent stalls with their routes and stacks"""
+    return {
+        "monitoring": EVENT_LOOP_MONITOR,
+        "samples": len(loop_lag_samples),
+        "lag_ms": lag_percentiles(),
+        "stall_threshold_ms": EVENT_LOOP_STALL_THRESHOLD_MS,
+        "stalls_total": loop_monitor_state["stalls_total"],
+        "recent_stalls": [
+            {
+                "timestamp": stall["timestamp"],
+                "duration_ms": stall["duration_ms"],
+                "route": stall["route"],
+                "stack": stall["stack"]
+            }
+            for stall in reversed(loop_stalls)
+        ]
+    }
+
+@app.get("/bank/search")
+async def search_question_bank(
+    q: str,
+    topic: Optional[str] = None,
+    difficulty: Optional[str] = None,
+    limit: int = 20
+):
+    """Search the question bank by terms, topic and difficulty"""
+    if question_bank is None:
+        raise HTTPException(status_code=404, detail="Question bank is disabled")
+    
+    questions = await asyncio.to_thread(question_bank.search, q, topic, difficulty, limit)
+    
+    return {
+        "questions": [QuestionResponse(**question) for question in questions],
+        "total": len(questions)
     }
 
+@app.post("/tasks/{task_id}/cancel")
+async def cancel_task_endpoint(task_id: str):
+    """Cancel a pending or processing task"""
+    if task_id not in task_storage:
+        raise HTTPException(status_code=404, detail="Task not found")
+    
+    task = task_storage[task_id]
+    
+    if task["status"] == TaskStatus.CANCELLED:
+        return {"message": f"Task {task_id} already cancelled", "status": task["status"]}
+    
+    if not cancel_task(task_id, "Task cancelled by client"):
+        raise HTTPException(
+            status_code=409,
+            detail=f"Task already {task['status'].value}"
+        )
+    
+    return {"message": f"Task {task_id} cancelled", "status": task["status"]}
+
 @app.delete("/tasks/{task_id}")
 async def delete_task(task_id: str):
     """Delete a task"""
@@ -561,13 +2186,15 @@ async def delete_task(task_id: str):
     
     task = task_storage[task_id]
     
-    # Only allow deletion of completed or failed tasks
+    # Only allow deletion of finished tasks
     if task["status"] in [TaskStatus.PENDING, TaskStatus.PROCESSING]:
         raise HTTPException(
             status_code=400, 
-            detail="Cannot delete active task. Wait for completion or failure."
+            detail="Cannot delete active task. Cancel it first via POST /tasks/{task_id}/cancel."
         )
     
+    if task.get("idempotency_key"):
+        idempotency_keys.pop(task["idempotency_key"], None)
     del task_storage[task_id]
     
     return {"message": f"Task {task_id} deleted successfully"}
@@ -576,8 +2203,15 @@ async def delete_task(task_id: str):
 @app.post("/generate", response_model=GenerationResult)
 async def generate_questions_endpoint(input_data: QuestionInput):
     """Generate questions from text materials (DEPRECATED: Use /tasks/generate instead)"""
+    if input_data.num_questions > MAX_QUESTIONS_PER_CALL:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_QUESTIONS_PER_CALL} questions per synchronous call. Use /tasks/generate for larger papers."
+        )
+    
     try:
-        result = generate_questions(input_data.materials, input_data.num_questions)
+        materials, _ = await asyncio.to_thread(normalize_materials, input_data.materials)
+        result = await asyncio.to_thread(generate_questions, materials, input_data.num_questions)
         
         return GenerationResult(
             questions=[QuestionResponse(**q) for q in result["questions"]],
@@ -589,15 +2223,21 @@ async def generate_questions_endpoint(input_data: QuestionInput):
 @app.post("/generate/pdf")
 async def generate_from_pdf(
     pdf_file: UploadFile = File(...),
-    num_questions: int = 5
+    num_questions: int = Query(5, ge=1)
 ):
     """Generate questions from PDF file (DEPRECATED: Use /tasks/generate/pdf instead)"""
+    if num_questions > MAX_QUESTIONS_PER_CALL:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_QUESTIONS_PER_CALL} questions per synchronous call. Use /tasks/generate/pdf for larger papers."
+        )
+    
     try:
         # Extract text from PDF
-        materials = extract_pdf_text(pdf_file)
+        materials, _ = await asyncio.to_thread(lambda: normalize_materials(extract_pdf_text(pdf_file)))
         
         # Generate questions
-        result = generate_questions(materials, num_questions)
+        result = await asyncio.to_thread(generate_questions, materials, num_questions)
         
         return {
             "questions": result["questions"],
@@ -0,0 +1,114 @@
+"""Shared fixtures: an isolated app with a stubbed LLM and a temporary question bank"""
+
+import asyncio
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+
+import pytest
+
+# Configure the service before it is imported: no default bank on disk, and
+# fail any request whose handler blocks the event loop
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ["QUESTION_BANK_PATH"] = ""
+os.environ["EVENT_LOOP_STRICT"] = "true"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as service  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from langchain_core.messages import AIMessage  # noqa: E402
+
+_COUNT_PATTERN = re.compile(r"Generate (?:exactly )?(\d+)(?: high-quality exam)? questions")
+
+
+def prompt_text(prompt) -> str:
+    """Flatten a string or message-list prompt"""
+    if isinstance(prompt, str):
+        return prompt
+    return "\n".join(message.content for message in prompt)
+
+
+class StubLLM:
+    """Fake chat model returning unique, well-formed questions.
+
+    Calls block while `gate` is cleared, and `fail_once` lets a test make the
+    first call whose prompt matches a predicate raise.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.cancelled = 0
+        self.gate = threading.Event()
+        self.gate.set()
+        self.fail_once = None
+
+    async def ainvoke(self, prompt):
+        text = prompt_text(prompt)
+        self.calls.append(text)
+        try:
+            while not self.gate.is_set():
+                await asyncio.sleep(0.01)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+        if self.fail_once is not None and self.fail_once(text):
+            self.fail_once = None
+            raise RuntimeError("provider error")
+
+        count = int(_COUNT_PATTERN.search(text).group(1))
+        questions = [
+            {
+                # Every token is unique, so stub questions never look like near-duplicates
+                "question": " ".join(uuid.uuid4().hex[:8] for _ in range(8)) + "?",
+                "answer": "answer",
+                "difficulty": "easy",
+                "topic": "topic",
+                "explanation": "explanation",
+            }
+            for _ in range(count)
+        ]
+        return AIMessage(
+            content=json.dumps({"questions": questions}),
+            usage_metadata={"input_tokens": 1200, "output_tokens": 300, "total_tokens": 1500},
+        )
+
+
+@pytest.fixture
+def stub_llm():
+    return StubLLM()
+
+
+@pytest.fixture
+def client(stub_llm, tmp_path, monkeypatch):
+    """TestClient over a fresh service state; startup hooks (event-loop monitor) run"""
+    monkeypatch.setattr(service, "llm", stub_llm)
+    monkeypatch.setattr(service, "question_bank", service.QuestionBank(str(tmp_path / "bank.db")))
+    monkeypatch.setattr(service, "generation_slots", asyncio.Semaphore(service.MAX_CONCURRENT_GENERATIONS))
+    for state in (
+        service.task_storage,
+        service.idempotency_keys,
+        service.inflight_generations,
+        service.running_tasks,
+        service.question_history,
+        service.pregeneration_jobs,
+        service.pregeneration_queue,
+    ):
+        state.clear()
+
+    with TestClient(service.app) as test_client:
+        yield test_client
+
+
+def wait_for(condition, timeout: float = 5.0):
+    """Poll until `condition()` is true"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out waiting for condition")
+        time.sleep(0.01)
@@ -0,0 +1,174 @@
+"""Task API tests against a stubbed LLM: coalescing, cancellation, sharding, the question bank and caching"""
+
+import threading
+import time
+
+import pytest
+
+from conftest import service, wait_for
+
+MATERIALS = "Photosynthesis converts light energy into chemical energy stored in glucose. " * 5
+
+
+def submit_in_background(client, body):
+    """POST a task from another thread; TestClient only returns once background work is done"""
+    thread = threading.Thread(target=client.post, args=("/tasks/generate",), kwargs={"json": body})
+    thread.start()
+    return thread
+
+
+def run_task(client, body) -> str:
+    client.post("/tasks/generate", json=body)
+    return max(service.task_storage.values(), key=lambda task: task["created_at"])["task_id"]
+
+
+def test_cancelling_one_coalesced_task_keeps_the_shared_call(client, stub_llm):
+    stub_llm.gate.clear()
+    body = {"materials": MATERIALS, "num_questions": 3, "use_question_bank": False}
+    first_thread = submit_in_background(client, body)
+    wait_for(lambda: len(stub_llm.calls) == 1)
+    second_thread = submit_in_background(client, body)
+    wait_for(lambda: any(task.get("coalesced") for task in service.task_storage.values()))
+
+    first = next(task for task in service.task_storage.values() if not task.get("coalesced"))
+    second = next(task for task in service.task_storage.values() if task.get("coalesced"))
+
+    response = client.post(f"/tasks/{first['task_id']}/cancel")
+    assert response.status_code == 200
+    assert response.json()["status"] == "cancelled"
+    assert client.get(f"/tasks/{second['task_id']}/status").json()["status"] == "processing"
+
+    stub_llm.gate.set()
+    first_thread.join(5)
+    second_thread.join(5)
+
+    assert len(stub_llm.calls) == 1
+    assert stub_llm.cancelled == 0
+    assert client.get(f"/tasks/{first['task_id']}/status").json()["status"] == "cancelled"
+    result = client.get(f"/tasks/{second['task_id']}/result").json()
+    assert result["status"] == "completed"
+    assert len(result["result"]["questions"]) == 3
+    assert client.get("/health").json()["provider_calls_saved_by_coalescing"] >= 1
+
+
+def test_cancelling_every_coalesced_task_aborts_the_provider_call(client, stub_llm):
+    stub_llm.gate.clear()
+    body = {"materials": MATERIALS, "num_questions": 3, "use_question_bank": False}
+    threads = [submit_in_background(client, body)]
+    wait_for(lambda: len(stub_llm.calls) == 1)
+    threads.append(submit_in_background(client, body))
+    wait_for(lambda: any(task.get("coalesced") for task in service.task_storage.values()))
+
+    for task_id in list(service.task_storage):
+        assert client.post(f"/tasks/{task_id}/cancel").status_code == 200
+    for thread in threads:
+        thread.join(5)
+
+    wait_for(lambda: stub_llm.cancelled == 1)
+    assert not service.inflight_generations
+    assert service.generation_slots._value == service.MAX_CONCURRENT_GENERATIONS
+    assert all(task["status"] == service.TaskStatus.CANCELLED for task in service.task_storage.values())
+    # Cancelled tasks can be deleted
+    task_id = next(iter(service.task_storage))
+    assert client.delete(f"/tasks/{task_id}").status_code == 200
+
+
+def test_failed_shard_is_retried_alone(client, stub_llm):
+    stub_llm.fail_once = lambda prompt: "part 2 of 3" in prompt
+    task_id = run_task(client, {"materials": MATERIALS, "num_questions": 12, "use_question_bank": False})
+
+    status = client.get(f"/tasks/{task_id}/status").json()
+    assert status["status"] == "completed"
+    assert status["shards_total"] == 3
+    assert status["shards_completed"] == 3
+
+    result = client.get(f"/tasks/{task_id}/result").json()
+    assert len(result["result"]["questions"]) == 12
+    # Three shards plus one retry of the failed shard; the failed call reported no usage
+    assert len(stub_llm.calls) == 4
+    assert len(result["usage"]["calls"]) == 3
+
+
+def test_resubmitted_materials_are_served_from_the_bank(client, stub_llm):
+    body = {"materials": MATERIALS, "num_questions": 5}
+    first_id = run_task(client, body)
+    assert len(stub_llm.calls) == 1
+
+    second_id = run_task(client, body)
+    result = client.get(f"/tasks/{second_id}/result").json()["result"]
+
+    assert len(stub_llm.calls) == 1
+    assert result["bank_hits"] == 5
+    assert result["bank_hit_ratio"] == 1.0
+    first_questions = client.get(f"/tasks/{first_id}/result").json()["result"]["questions"]
+    assert {q["question"] for q in result["questions"]} == {q["question"] for q in first_questions}
+
+
+def test_course_history_survives_restart(client, stub_llm):
+    body = {"materials": MATERIALS, "num_questions": 5, "course_id": "BIO101"}
+    run_task(client, body)
+
+    # A restart loses the in-memory history; banked questions must still not be reissued
+    service.question_history.clear()
+    task_id = run_task(client, body)
+    result = client.get(f"/tasks/{task_id}/result").json()["result"]
+
+    assert result["bank_hits"] == 0
+    assert len(stub_llm.calls) == 2
+
+
+def test_pregenerated_questions_serve_later_tasks(client, stub_llm):
+    job = client.post("/pregenerate", json={"materials": MATERIALS, "questions_per_chunk": 5}).json()
+    wait_for(lambda: client.get(f"/pregenerate/{job['job_id']}").json()["status"] == "completed")
+    assert len(stub_llm.calls) == 1
+
+    task_id = run_task(client, {"materials": MATERIALS, "num_questions": 5})
+    assert client.get(f"/tasks/{task_id}/result").json()["result"]["bank_hits"] == 5
+    assert len(stub_llm.calls) == 1
+
+
+def test_finished_result_supports_conditional_get(client):
+    task_id = run_task(client, {"materials": MATERIALS, "num_questions": 5, "use_question_bank": False})
+
+    response = client.get(f"/tasks/{task_id}/result")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+
+    not_modified = client.get(f"/tasks/{task_id}/result", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+
+    listing = client.get("/tasks")
+    assert client.get("/tasks", headers={"If-None-Match": listing.headers["etag"]}).status_code == 304
+
+
+def test_refused_gzip_is_not_chosen_through_wildcard():
+    assert service.choose_encoding("gzip;q=0, *") is None
+    assert service.choose_encoding("*") == "gzip"
+
+
+@pytest.mark.parametrize("url", [
+    "/tasks/generate/pdf?num_questions=0",
+    "/tasks/generate/pdf?num_questions=51",
+    "/pregenerate/pdf?questions_per_chunk=0",
+])
+def test_pdf_endpoints_validate_counts(client, url):
+    response = client.post(url, files={"pdf_file": ("notes.pdf", b"%PDF-1.4", "application/pdf")})
+    assert response.status_code == 422
+
+
+def test_strict_mode_fails_requests_that_block_the_event_loop(client):
+    async def blocking_handler():
+        time.sleep(0.5)
+        return {}
+
+    service.app.add_api_route("/test/blocking", blocking_handler)
+    route = service.app.router.routes[-1]
+    try:
+        with pytest.raises(RuntimeError, match="blocked the event loop"):
+            client.get("/test/blocking")
+    finally:
+        service.app.router.routes.remove(route)
+
+    metrics = client.get("/metrics/event-loop").json()
+    assert metrics["stalls_total"] >= 1